@@ -8,6 +8,7 @@ import numpy as np
 from scipy.io import loadmat
 import cv2
 
+import torch
 from torch.utils.data import Dataset
 import torchvision.transforms as transforms
 
@@ -118,7 +119,7 @@ class GANDataset(Dataset):
         return max(len(self.images_A), len(self.images_B))
 
 class GazeDataset(Dataset):
-    def __init__(self, dataset_root_path, split='train', random_transforms=False):
+    def __init__(self, dataset_root_path, split='train', random_transforms=False, cache_in_ram=False):
         'Initialization'
         print('Preparing '+split+' dataset...')
         self.split = split
@@ -136,6 +137,22 @@ class GazeDataset(Dataset):
             self.transforms = None
 
         self.images, self.labels = get_classification_data(dataset_root_path, self.split)
+        self.cache = None
+        if cache_in_ram:
+            # decode every image once and pack them into a single flat uint8 tensor in shared memory,
+            # so that dataloader workers can slice it without copies or repeated JPEG decoding
+            print('Caching '+split+' images in RAM...')
+            # PIL only reads the header here, which is enough to size the cache (cv2 always loads 3 channels)
+            self.shapes = [Image.open(path).size[::-1] + (3,) for path in self.images]
+            self.offsets = np.cumsum([0] + [int(np.prod(shape)) for shape in self.shapes])
+            self.cache = torch.empty(int(self.offsets[-1]), dtype=torch.uint8).share_memory_()
+            # fill the cache one image at a time so that only a single decoded image is held besides it
+            for idx, path in enumerate(self.images):
+                im = cv2.imread(path)
+                # the header size ignores EXIF orientation which cv2 applies, so make sure the two agree
+                if im.shape != self.shapes[idx]:
+                    raise ValueError('Decoded shape {} of {} does not match its header size {}'.format(im.shape, path, self.shapes[idx]))
+                self.cache[self.offsets[idx]:self.offsets[idx+1]] = torch.from_numpy(im.ravel())
         print('Finished preparing '+split+' dataset!')
 
     def __len__(self):
@@ -145,7 +162,10 @@ class GazeDataset(Dataset):
     def __getitem__(self, index):
         'Generates one sample of data'
         y = self.labels[index]
-        im = Image.fromarray(cv2.imread(self.images[index])) #cv2 loads 3 channel image by default
+        if self.cache is None:
+            im = Image.fromarray(cv2.imread(self.images[index])) #cv2 loads 3 channel image by default
+        else:
+            im = Image.fromarray(self.cache[self.offsets[index]:self.offsets[index+1]].numpy().reshape(self.shapes[index]))
 
         if self.transforms is None:
             X = self.normalize(self.prepare_input(im))
@@ -154,10 +154,10 @@ def train(netGaze, epoch):
 
         scores, masks = netGaze(data)
         scores = scores.view(-1, args.num_classes)
-        loss = F.nll_loss(scores, targets)
+        loss = F.cross_entropy(scores, targets)
 
         # compute the accuracy
-        pred = scores.data.max(1)[1]  # get the index of the max log-probability
+        pred = scores.data.max(1)[1]  # get the index of the max logit
         pred_all   = np.append(pred_all, pred.cpu().numpy())
         target_all = np.append(target_all, targets.cpu().numpy())
 
@@ -1,21 +1,21 @@
 import os
 import json
+import contextlib
 from datetime import datetime
-from statistics import mean
 import argparse
 
 import numpy as np
 import matplotlib.pyplot as plt
-from sklearn.metrics import confusion_matrix
-from sklearn.utils.multiclass import unique_labels
 
 import torch
 import torch.optim as optim
-from torch.autograd import Variable
 import torch.nn.functional as F
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
 
 from models import SqueezeNet
 from datasets import GazeDataset
+from utils import CUDAPrefetcher
 
 
 parser = argparse.ArgumentParser('Options for training GazeNet in PyTorch...')
@@ -28,10 +28,14 @@ parser.add_argument('--epochs', type=int, default=50, metavar='N', help='number
 parser.add_argument('--learning-rate', type=float, default=0.0005, metavar='LR', help='learning rate')
 parser.add_argument('--momentum', type=float, default=0.9, metavar='M', help='momentum for gradient step')
 parser.add_argument('--weight-decay', type=float, default=0.0005, metavar='WD', help='weight decay')
+parser.add_argument('--accum-steps', type=int, default=1, metavar='K', help='number of batches to accumulate gradients over before each optimizer step')
 parser.add_argument('--log-schedule', type=int, default=10, metavar='N', help='number of iterations to print/save log after')
+parser.add_argument('--cm-schedule', type=int, default=10, metavar='N', help='number of epochs to plot confusion matrix of best model after')
 parser.add_argument('--seed', type=int, default=1, help='set seed to some constant value to reproduce experiments')
 parser.add_argument('--no-cuda', action='store_true', default=False, help='do not use cuda for training')
 parser.add_argument('--random-transforms', action='store_true', default=False, help='apply random transforms to input while training')
+parser.add_argument('--preload-gpu', action='store_true', default=False, help='decode the whole dataset once and keep it on the GPU')
+parser.add_argument('--cache-in-ram', action='store_true', default=False, help='decode all images once and cache them in shared memory')
 
 
 args = parser.parse_args()
@@ -40,6 +44,10 @@ if args.dataset_root_path is None:
     assert False, 'Path to dataset not provided!'
 if all(args.version != x for x in ['1_0', '1_1']):
     assert False, 'Model version not recognized!'
+if args.preload_gpu and args.random_transforms:
+    assert False, 'Cannot preload dataset to GPU when using random transforms!'
+if args.accum_steps < 1:
+    assert False, 'Number of gradient accumulation steps must be positive!'
 
 # Output class labels
 activity_classes = ['Eyes Closed', 'Forward', 'Shoulder', 'Left Mirror', 'Lap', 'Speedometer', 'Radio', 'Rearview', 'Right Mirror']
@@ -47,27 +55,54 @@ args.num_classes = len(activity_classes)
 
 # setup args
 args.cuda = not args.no_cuda and torch.cuda.is_available()
+# multi-GPU training is enabled when launched with torchrun, e.g. torchrun --nproc_per_node=N gazenet.py ...
+args.distributed = 'LOCAL_RANK' in os.environ
+if args.distributed:
+    if not args.cuda:
+        assert False, 'Distributed training requires CUDA!'
+    dist.init_process_group('nccl')
+    args.local_rank = int(os.environ['LOCAL_RANK'])
+    args.world_size = dist.get_world_size()
+    torch.cuda.set_device(args.local_rank)
+else:
+    args.local_rank, args.world_size = 0, 1
+# only the main process writes logs, plots and snapshots
+args.main_process = not args.distributed or dist.get_rank() == 0
+
 if args.output_dir is None:
     args.output_dir = datetime.now().strftime("%Y-%m-%d-%H:%M")
     args.output_dir = os.path.join('.', 'experiments', 'gazenet', args.output_dir)
-
-if not os.path.exists(args.output_dir):
-    os.makedirs(args.output_dir)
-else:
-    assert False, 'Output directory already exists!'
-
-# store config in output directory
-with open(os.path.join(args.output_dir, 'config.json'), 'w') as f:
-    json.dump(vars(args), f)
+if args.distributed:
+    # make sure all processes agree on the (timestamped) output directory
+    output_dir = [args.output_dir]
+    dist.broadcast_object_list(output_dir, src=0)
+    args.output_dir = output_dir[0]
+
+if args.main_process:
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    else:
+        assert False, 'Output directory already exists!'
+
+    # store config in output directory
+    with open(os.path.join(args.output_dir, 'config.json'), 'w') as f:
+        json.dump(vars(args), f)
 
 torch.manual_seed(args.seed)
 if args.cuda:
     torch.cuda.manual_seed(args.seed)
 
+# input shapes are fixed, so let cuDNN benchmark and pick the fastest conv algorithms
+torch.backends.cudnn.benchmark = True
+torch.backends.cudnn.deterministic = False
+# allow TF32 for any matmuls/convs that still run in FP32
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+
 
-def plot_confusion_matrix(y_true, y_pred, classes, normalize=True, title=None, cmap=plt.cm.Blues):
+def plot_confusion_matrix(cm, classes, normalize=True, title=None, cmap=plt.cm.Blues):
     """
-    This function prints and plots the confusion matrix.
+    This function prints and plots the (true label x predicted label) confusion matrix `cm`.
     Normalization can be applied by setting `normalize=True`.
     """
     if not title:
@@ -76,12 +111,8 @@ def plot_confusion_matrix(y_true, y_pred, classes, normalize=True, title=None, c
         else:
             title = 'Confusion matrix, without normalization'
 
-    # Compute confusion matrix
-    cm = confusion_matrix(y_true, y_pred)
-    # Only use the labels that appear in the data
-    #classes = classes[unique_labels(y_true, y_pred)]
     if normalize:
-        cm = cm.astype('float') / cm.sum(axis=1)[:, np.newaxis]
+        cm = cm.astype('float') / np.maximum(cm.sum(axis=1), 1)[:, np.newaxis]
 
     fig3, ax3 = plt.subplots()
     im = ax3.imshow(cm, interpolation='nearest', cmap=cmap)
@@ -102,108 +133,161 @@ def plot_confusion_matrix(y_true, y_pred, classes, normalize=True, title=None, c
     # Loop over data dimensions and create text annotations.
     fmt = '.2f' if normalize else 'd'
     thresh = cm.max() / 2.
+    colors = np.where(cm > thresh, 'white', 'black')
+    texts = np.vectorize(lambda v: format(v, fmt))(cm)
     for i in range(cm.shape[0]):
         for j in range(cm.shape[1]):
-            ax3.text(j, i, format(cm[i, j], fmt),
+            ax3.text(j, i, texts[i, j],
                     ha="center", va="center",
-                    color="white" if cm[i, j] > thresh else "black")
+                    color=colors[i, j])
     fig3.tight_layout()
     fig3.savefig(os.path.join(args.output_dir, 'confusion_matrix.jpg'))
+    plt.close(fig3)
     return
 
 
-kwargs = {'batch_size': args.batch_size, 'shuffle': True, 'num_workers': 6}
-train_loader = torch.utils.data.DataLoader(GazeDataset(args.dataset_root_path, 'train', args.random_transforms), **kwargs)
-val_loader = torch.utils.data.DataLoader(GazeDataset(args.dataset_root_path, 'val', False), **kwargs)
+def preload_gpu(dataset):
+    """
+    Decodes every sample of the dataset once and returns them as a TensorDataset on the GPU.
+    """
+    X, y = zip(*[dataset[i] for i in range(len(dataset))])
+    return torch.utils.data.TensorDataset(torch.stack(X).cuda(), torch.tensor(y).cuda())
+
+
+def unwrap(netGaze):
+    """
+    Returns the plain SqueezeNet from behind any torch.compile/DistributedDataParallel wrappers.
+    """
+    netGaze = getattr(netGaze, '_orig_mod', netGaze)
+    return netGaze.module if isinstance(netGaze, DDP) else netGaze
+
+
+# split the cores among the processes on this node, leave a couple for each main process, and keep workers alive across epochs
+local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+kwargs = {'batch_size': args.batch_size, 'shuffle': True, 'num_workers': max(2, min((os.cpu_count() or 4) // local_world_size - 2, 8)),
+          'persistent_workers': True, 'prefetch_factor': 4, 'pin_memory': args.cuda}
+train_ds = GazeDataset(args.dataset_root_path, 'train', args.random_transforms, args.cache_in_ram)
+val_ds = GazeDataset(args.dataset_root_path, 'val', False, args.cache_in_ram)
+if args.preload_gpu and args.cuda:
+    # samples already live on the GPU, so there is nothing for workers or pinned memory to do
+    train_ds, val_ds = preload_gpu(train_ds), preload_gpu(val_ds)
+    kwargs = {'batch_size': args.batch_size, 'shuffle': True, 'num_workers': 0, 'pin_memory': False}
+# drop the last incomplete batch so that training steps always see the same input shape; the smaller
+# last validation batch and the switch to eval mode each cost one extra compilation of the model
+if args.distributed:
+    # every process sees its own shard of the training set, while validation runs on the full set everywhere
+    train_loader = torch.utils.data.DataLoader(train_ds, drop_last=True,
+        sampler=torch.utils.data.distributed.DistributedSampler(train_ds), **dict(kwargs, shuffle=False))
+else:
+    train_loader = torch.utils.data.DataLoader(train_ds, drop_last=True, **kwargs)
+val_loader = torch.utils.data.DataLoader(val_ds, **dict(kwargs, shuffle=False))
 
 # global var to store best validation accuracy across all epochs
 best_accuracy = 0.0
+# confusion matrix of the best model that has not been plotted yet
+best_cm = None
 
 
 # training function
 def train(netGaze, epoch):
-    epoch_loss = list()
-    correct = 0
-    netGaze.train()
-    for b_idx, (data, targets) in enumerate(train_loader):
-        if args.cuda:
-            data, targets = data.cuda(), targets.cuda()
-        # convert the data and targets into Variable and cuda form
-        data, targets = Variable(data), Variable(targets)
-
-        # train the network
-        optimizer.zero_grad()
-
-        scores, masks = netGaze(data)
-        scores = scores.view(-1, args.num_classes)
-        loss = F.nll_loss(scores, targets)
-
-        # compute the accuracy
-        pred = scores.data.max(1)[1]  # get the index of the max log-probability
-        correct += pred.eq(targets.data).cpu().sum()
-
-        epoch_loss.append(loss.item())
-        loss.backward()
-        optimizer.step()
-
-        if b_idx % args.log_schedule == 0:
-            print('Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}'.format(
-                epoch, (b_idx+1) * len(data), len(train_loader.dataset),
-                100. * (b_idx+1)*len(data) / len(train_loader.dataset), loss.item()))
-            with open(os.path.join(args.output_dir, "logs.txt"), "a") as f:
-                f.write('Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}\n'.format(
-                epoch, (b_idx+1) * len(data), len(train_loader.dataset),
-                100. * (b_idx+1)*len(data) / len(train_loader.dataset), loss.item()))
-
-    # now that the epoch is completed calculate statistics and store logs
-    avg_loss = mean(epoch_loss)
-    print("------------------------\nAverage loss for epoch = {:.2f}".format(avg_loss))
-    with open(os.path.join(args.output_dir, "logs.txt"), "a") as f:
-        f.write("\n------------------------\nAverage loss for epoch = {:.2f}\n".format(avg_loss))
-
-    train_accuracy = 100.0*float(correct)/float(len(train_loader.dataset))
-    print("Accuracy for epoch = {:.2f}%\n------------------------".format(train_accuracy))
-    with open(os.path.join(args.output_dir, "logs.txt"), "a") as f:
-        f.write("Accuracy for epoch = {:.2f}%\n------------------------\n".format(train_accuracy))
+    # accumulate on the device so that no sync is needed until the end of the epoch
+    correct = torch.zeros((), dtype=torch.long, device='cuda' if args.cuda else 'cpu')
+    loss_sum = torch.zeros((), device='cuda' if args.cuda else 'cpu')
+    # keep the log file open for the whole epoch and let writes be buffered
+    with (open(os.path.join(args.output_dir, "logs.txt"), "a", buffering=8192) if args.main_process else contextlib.nullcontext()) as log_fp:
+        netGaze.train()
+        optimizer.zero_grad(set_to_none=True)
+        for b_idx, (data, targets) in enumerate(CUDAPrefetcher(train_loader) if args.cuda else train_loader):
+            if args.cuda:
+                data = data.contiguous(memory_format=torch.channels_last)
+            # only step (and allreduce gradients) once every args.accum_steps batches, and at the end of the epoch
+            step = (b_idx+1) % args.accum_steps == 0 or (b_idx+1) == len(train_loader)
+            # the last group of the epoch may hold fewer than args.accum_steps batches
+            group_size = min(args.accum_steps, len(train_loader) - (b_idx // args.accum_steps) * args.accum_steps)
+
+            # train the network
+            with netGaze.no_sync() if args.distributed and not step else contextlib.nullcontext():
+                with torch.amp.autocast('cuda', dtype=torch.float16, enabled=args.cuda):
+                    scores, masks = netGaze(data)
+                    scores = scores.view(-1, args.num_classes)
+                    loss = F.cross_entropy(scores, targets)
+                scaler.scale(loss / group_size).backward()
+
+            # compute the accuracy
+            pred = scores.argmax(1)  # get the index of the max logit
+            correct += pred.eq(targets).sum()
+
+            loss_sum += loss.detach()
+            if step:
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad(set_to_none=True)
+
+            if b_idx % args.log_schedule == 0 and args.main_process:
+                log_line = 'Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}'.format(
+                    epoch, (b_idx+1) * len(data) * args.world_size, len(train_loader.dataset),
+                    100. * (b_idx+1)*len(data)*args.world_size / len(train_loader.dataset), loss.item())
+                print(log_line)
+                log_fp.write(log_line + '\n')
+
+        if args.distributed:
+            # gather statistics from all processes
+            dist.all_reduce(loss_sum)
+            dist.all_reduce(correct)
+
+        # now that the epoch is completed calculate statistics and store logs
+        avg_loss = loss_sum.item() / (len(train_loader)*args.world_size)
+        correct = correct.item()
+        train_accuracy = 100.0*float(correct)/float(len(train_loader)*args.batch_size*args.world_size)
+        if args.main_process:
+            print("------------------------\nAverage loss for epoch = {:.2f}".format(avg_loss))
+            log_fp.write("\n------------------------\nAverage loss for epoch = {:.2f}\n".format(avg_loss))
+            print("Accuracy for epoch = {:.2f}%\n------------------------".format(train_accuracy))
+            log_fp.write("Accuracy for epoch = {:.2f}%\n------------------------\n".format(train_accuracy))
     
     return netGaze, avg_loss, train_accuracy
 
 
 # validation function
 def val(netGaze):
-    global best_accuracy
-    correct = 0
+    global best_accuracy, best_cm
+    # accumulate on the device so that no sync is needed until the end of the epoch
+    correct = torch.zeros((), dtype=torch.long, device='cuda' if args.cuda else 'cpu')
     netGaze.eval()
-    pred_all = np.array([], dtype='int64')
-    target_all = np.array([], dtype='int64')
+    # confusion matrix is accumulated on the device as well, indexed by (target, prediction)
+    cm = torch.zeros(args.num_classes, args.num_classes, dtype=torch.long, device='cuda' if args.cuda else 'cpu')
     
-    for idx, (data, target) in enumerate(val_loader):
-        if args.cuda:
-            data, target = data.cuda(), target.cuda()
-        data, target = Variable(data), Variable(target)
-
-        # do the forward pass
-        scores = netGaze(data)[0]
-        scores = scores.view(-1, args.num_classes)
-        pred = scores.data.max(1)[1]  # got the indices of the maximum, match them
-        correct += pred.eq(target.data).cpu().sum()
-        print('Done with image {} out of {}...'.format(min(args.batch_size*(idx+1), len(val_loader.dataset)), len(val_loader.dataset)))
-        pred_all   = np.append(pred_all, pred.cpu().numpy())
-        target_all = np.append(target_all, target.cpu().numpy())
-
-    print("------------------------\nPredicted {} out of {}".format(correct, len(val_loader.dataset)))
+    with torch.inference_mode():
+        for idx, (data, target) in enumerate(CUDAPrefetcher(val_loader) if args.cuda else val_loader):
+            if args.cuda:
+                data = data.contiguous(memory_format=torch.channels_last)
+            # do the forward pass
+            with torch.amp.autocast('cuda', dtype=torch.float16, enabled=args.cuda):
+                scores = netGaze(data)[0]
+                scores = scores.view(-1, args.num_classes)
+            pred = scores.argmax(1)  # got the indices of the maximum, match them
+            correct += pred.eq(target).sum()
+            if args.main_process:
+                print('Done with image {} out of {}...'.format(min(args.batch_size*(idx+1), len(val_loader.dataset)), len(val_loader.dataset)))
+            # index_add_ (unlike bincount) does not need to read anything back to the host
+            cm.view(-1).index_add_(0, target*args.num_classes + pred, torch.ones_like(pred))
+
+    correct = correct.item()
     val_accuracy = 100.0*float(correct)/len(val_loader.dataset)
-    print("Validation accuracy = {:.2f}%\n------------------------".format(val_accuracy))
-    with open(os.path.join(args.output_dir, "logs.txt"), "a") as f:
-        f.write("\n------------------------\nPredicted {} out of {}\n".format(correct, len(val_loader.dataset)))
-        f.write("Validation accuracy = {:.2f}%\n------------------------\n".format(val_accuracy))
+    if args.main_process:
+        print("------------------------\nPredicted {} out of {}".format(correct, len(val_loader.dataset)))
+        print("Validation accuracy = {:.2f}%\n------------------------".format(val_accuracy))
+        with open(os.path.join(args.output_dir, "logs.txt"), "a") as f:
+            f.write("\n------------------------\nPredicted {} out of {}\n".format(correct, len(val_loader.dataset)))
+            f.write("Validation accuracy = {:.2f}%\n------------------------\n".format(val_accuracy))
 
     # now save the model if it has better accuracy than the best model seen so forward
     if val_accuracy > best_accuracy:
         best_accuracy = val_accuracy
-        # save the model
-        torch.save(netGaze.state_dict(), os.path.join(args.output_dir, 'netGaze.pth'))
-        plot_confusion_matrix(target_all, pred_all, activity_classes)
+        # save the model, unwrapped so that the saved keys match the plain SqueezeNet
+        if args.main_process:
+            torch.save(unwrap(netGaze).state_dict(), os.path.join(args.output_dir, 'netGaze.pth'))
+            best_cm = cm.cpu().numpy()
 
     return val_accuracy
 
@@ -216,10 +300,17 @@ if __name__ == '__main__':
         netGaze.load_state_dict(torch.load(args.snapshot), strict=False)
 
     if args.cuda:
-        netGaze.cuda()
-
-    # create a temporary optimizer
-    optimizer = optim.SGD(netGaze.parameters(), lr=args.learning_rate, momentum=args.momentum, weight_decay=args.weight_decay)
+        # NHWC layout lets cuDNN use its faster tensor core kernels
+        netGaze = netGaze.cuda().to(memory_format=torch.channels_last)
+        if args.distributed:
+            netGaze = DDP(netGaze, device_ids=[args.local_rank])
+        # fuse the many small pointwise ops in the fire modules into fewer kernels
+        netGaze = torch.compile(netGaze, mode='max-autotune', dynamic=False)
+
+    # create a temporary optimizer, using the multi-tensor implementation to batch parameter updates
+    optimizer = optim.SGD(netGaze.parameters(), lr=args.learning_rate, momentum=args.momentum, weight_decay=args.weight_decay, foreach=True)
+    # loss scaler for mixed precision training (no-op when running on CPU)
+    scaler = torch.cuda.amp.GradScaler(enabled=args.cuda)
 
     fig1, ax1 = plt.subplots()
     plt.grid(True)
@@ -232,16 +323,29 @@ if __name__ == '__main__':
     ax2.legend()
     train_acc, val_acc = list(), list()
     for i in range(1, args.epochs+1):
+        if args.distributed:
+            # reshuffle the shards differently every epoch
+            train_loader.sampler.set_epoch(i)
         netGaze, avg_loss, acc = train(netGaze, i)
         # plot the loss
         train_loss.append(avg_loss)
         ax1.plot(train_loss, 'k')
-        fig1.savefig(os.path.join(args.output_dir, "train_loss.jpg"))
+        if args.main_process:
+            fig1.savefig(os.path.join(args.output_dir, "train_loss.jpg"))
 
         # plot the train and val accuracies
         train_acc.append(acc)
         val_acc.append(val(netGaze))
         ax2.plot(train_acc, 'g', label='Train accuracy')
         ax2.plot(val_acc, 'b', label='Validation accuracy')
-        fig2.savefig(os.path.join(args.output_dir, 'trainval_accuracy.jpg'))
+        if args.main_process:
+            fig2.savefig(os.path.join(args.output_dir, 'trainval_accuracy.jpg'))
+
+        # plot the confusion matrix of the best model only every few epochs
+        if best_cm is not None and (i % args.cm_schedule == 0 or i == args.epochs):
+            plot_confusion_matrix(best_cm, activity_classes)
+            best_cm = None
     plt.close('all')
+
+    if args.distributed:
+        dist.destroy_process_group()
@@ -155,8 +155,7 @@ class SqueezeNet(nn.Module):
             self.attention = nn.Sigmoid()
             self.head = nn.Sequential(
                 nn.ReLU(inplace=True),
-                nn.AdaptiveAvgPool2d((1, 1)),
-                nn.LogSoftmax(dim=1))
+                nn.AdaptiveAvgPool2d((1, 1)))
         elif version == '1_1':
             self.features = nn.Sequential(
                 nn.Conv2d(3, 64, kernel_size=3, stride=2),
@@ -180,8 +179,7 @@ class SqueezeNet(nn.Module):
             self.attention = nn.Sigmoid()
             self.head = nn.Sequential(
                 nn.ReLU(inplace=True),
-                nn.AdaptiveAvgPool2d((1, 1)),
-                nn.LogSoftmax(dim=1))
+                nn.AdaptiveAvgPool2d((1, 1)))
         else:
             raise ValueError("Unsupported SqueezeNet version {version}:"
                              "1_0/1_1 expected".format(version=version))
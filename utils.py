@@ -114,6 +114,36 @@ class LambdaLR():
     def step(self, epoch):
         return 1.0 - max(0, epoch + self.offset - self.decay_start_epoch)/(self.n_epochs - self.decay_start_epoch)
 
+class CUDAPrefetcher():
+    def __init__(self, loader):
+        # copies the next batch to the GPU on a side stream while the current one is being processed
+        self.loader = iter(loader)
+        self.stream = torch.cuda.Stream()
+        self._preload()
+
+    def _preload(self):
+        try:
+            self.batch = next(self.loader)
+        except StopIteration:
+            self.batch = None
+            return
+        with torch.cuda.stream(self.stream):
+            self.batch = [x.to('cuda', non_blocking=True) for x in self.batch]
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        torch.cuda.current_stream().wait_stream(self.stream)
+        batch = self.batch
+        if batch is None:
+            raise StopIteration
+        # the tensors were allocated on the side stream, so tell the allocator they are used here too
+        for x in batch:
+            x.record_stream(torch.cuda.current_stream())
+        self._preload()
+        return batch
+
 def weights_init_normal(m):
     classname = m.__class__.__name__
     if classname.find('Conv') != -1: